@@ -1,220 +1,846 @@
 
-from flask import Flask, request, render_template_string, jsonify
+from quart import Quart, request
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
+from cachetools import LRUCache, TTLCache
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageOps, features
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget, ValueTarget
 import os
+import re
+import asyncio
 import base64
+import hashlib
+from typing import Union
+from concurrent.futures import ThreadPoolExecutor
+import zlib
+import gzip
+import brotli
 from dotenv import load_dotenv
 import secrets
-import google.generativeai as genai
-import json
+import tempfile
+import httpx
+from google import genai
+from google.genai import errors, types
+import orjson
+import msgspec
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
 load_dotenv()
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 
-# Configure Gemini API
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-
-app = Flask(__name__)
+GEMINI_MODEL = 'gemini-2.0-flash'
+# Batch jobs run offline at half the cost of interactive calls
+GEMINI_BATCH_MODEL = 'gemini-2.5-flash'
+
+# Async SDK client for generation, streaming and the Batch API.
+# One HTTP/2 connection pool shared by every SDK call, so concurrent requests
+# multiplex over a few warm connections instead of opening new ones
+gemini_http = httpx.AsyncClient(http2=True, timeout=60.0,
+                                limits=httpx.Limits(max_connections=200,
+                                                    max_keepalive_connections=100))
+genai_client = genai.Client(
+    api_key=GEMINI_API_KEY,
+    http_options=types.HttpOptions(httpx_async_client=gemini_http)) if GEMINI_API_KEY else None
+
+app = Quart(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 8 * 1024 * 1024  # 8 MB
-app.config['UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png']
+app.config['UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.webp']
+
+# app.logger hands records to a background thread through a queue, so writing
+# them never blocks the event loop. Quart logs DEBUG and up under the debug
+# server and WARNING and up otherwise; LOG_LEVEL (e.g. DEBUG) overrides that.
+if os.getenv('LOG_LEVEL'):
+    app.logger.setLevel(os.getenv('LOG_LEVEL').upper())
+
+# Gemini downsizes images internally, so never send more than this
+MAX_IMAGE_SIDE = 1024
+HAVE_WEBP = features.check('webp')
+WEBP_QUALITY = 80
+JPEG_QUALITY = 85  # used instead when Pillow was built without WebP
+
+# Uploads larger than this are spooled to a temporary file while they arrive
+UPLOAD_SPOOL_SIZE = 2 * 1024 * 1024
+
+@app.after_serving
+async def close_gemini_http():
+    # The SDK leaves clients it was handed open
+    await gemini_http.aclose()
+
+
+# Threads for image decoding/resizing, so it runs off the event loop.
+# Pillow releases the GIL for most of the work, and under Hypercorn each
+# worker process already takes a core of its own
+image_pool = None
+
+
+@app.before_serving
+async def start_image_pool():
+    global image_pool
+    image_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+
+@app.after_serving
+async def stop_image_pool():
+    image_pool.shutdown(cancel_futures=True)
 
 # -----------------
 # Helper functions
 # -----------------
 
-def image_to_data_url(image_bytes):
-    b64 = base64.b64encode(image_bytes).decode('utf-8')
-    return f"data:image/jpeg;base64,{b64}"
+# Caches are only touched from the event loop, so they need no locking
+
+# Preprocessed images keyed by the upload digest
+_image_cache = LRUCache(maxsize=32)
+
+# Gemini results keyed by response_cache_key(); entries expire after an hour
+# so repeat visitors still get fresh suggestions now and then
+RESPONSE_CACHE_VERSION = 'v1'  # bump whenever the prompts change to drop every old entry
+_response_cache = TTLCache(maxsize=10_000, ttl=3600)
+cache_stats = {'hits': 0, 'misses': 0}
+
+
+def upload_digest(image_bytes):
+    """BLAKE2b digest of an upload, shared by the image and response caches"""
+    return hashlib.blake2b(image_bytes, digest_size=16).digest()
+
+
+def response_cache_key(digest, length, tone, region, mood, num):
+    """Versioned response cache key for one photo and set of options"""
+    return f"{RESPONSE_CACHE_VERSION}-{length}:{tone}:{region}:{mood}:{num}:{digest.hex()}"
+
+
+def cached_response(key):
+    """Cached Gemini result for key, or None; counts hits and misses for /metrics"""
+    result = _response_cache.get(key)
+    cache_stats['hits' if result is not None else 'misses'] += 1
+    return result
+
+
+class UploadError(Exception):
+    """Rejected upload; answered with a JSON error by the handler below"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+@app.errorhandler(UploadError)
+async def handle_upload_error(e):
+    return json_response({'error':str(e)}, e.status)
+
+
+# Smaller JSON bodies fit in a packet or two and aren't worth compressing
+JSON_COMPRESS_MIN = 1024
+
+# Fast settings: unlike the index page, JSON is compressed per request
+JSON_ENCODERS = {
+    'br': lambda body: brotli.compress(body, quality=4),
+    'gzip': lambda body: gzip.compress(body, compresslevel=6),
+}
+
+
+def json_response(payload, status=200):
+    """JSON response encoded with orjson, compressed when the client accepts it"""
+    body = orjson.dumps(payload)
+    headers = {}
+    if len(body) >= JSON_COMPRESS_MIN:
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = request.accept_encodings.best_match(list(JSON_ENCODERS))
+        if encoding:
+            headers['Content-Encoding'] = encoding
+            body = JSON_ENCODERS[encoding](body)
+    return app.response_class(body, status=status, headers=headers, mimetype='application/json')
+
+
+# Bytes needed to recognise every format sniff_image_type accepts
+IMAGE_HEAD_SIZE = 12
+
+
+def sniff_image_type(head):
+    """MIME type of an accepted image format from its first bytes, or None"""
+    if head[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def image_mime_type(image_bytes):
+    """Pick the MIME type for Gemini's inline_data from the file signature"""
+    return sniff_image_type(image_bytes[:IMAGE_HEAD_SIZE]) or "image/jpeg"
+
+
+def preprocess_image(image_bytes):
+    """
+    Downscale an upload so its long side is at most MAX_IMAGE_SIDE and
+    re-encode it as WebP. Returns (bytes, mime_type); undecodable input is
+    passed through unchanged.
+    """
+    try:
+        im = Image.open(BytesIO(image_bytes))
+        # Let libjpeg decode straight to a reduced size when it can
+        im.draft('RGB', (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.LANCZOS)
+        buf = BytesIO()
+        im = im.convert("RGB")
+        if HAVE_WEBP:
+            im.save(buf, "WEBP", quality=WEBP_QUALITY, method=4)
+            return buf.getvalue(), "image/webp"
+        im.save(buf, "JPEG", quality=JPEG_QUALITY, optimize=False, progressive=False)
+        return buf.getvalue(), "image/jpeg"
+    except Exception as e:
+        app.logger.warning("Image preprocessing error: %s", e)
+        return image_bytes, image_mime_type(image_bytes)
+
+
+async def preprocess_image_cached(image_bytes, digest=None):
+    """
+    preprocess_image run in the image worker pool, memoised so retries and
+    duplicate uploads are free. Pass the upload_digest if already known.
+    """
+    key = digest or upload_digest(image_bytes)
+    result = _image_cache.get(key)
+    if result is None:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(image_pool, preprocess_image, image_bytes)
+        _image_cache[key] = result
+    return result
+
+
+def is_allowed_upload(filename):
+    filename = secure_filename(filename or '')
+    ext = os.path.splitext(filename)[1].lower()
+    return ext in app.config['UPLOAD_EXTENSIONS']
+
+
+class SpooledUploadTarget(BaseTarget):
+    """
+    Multipart target that hashes the upload as it arrives and keeps it in a
+    temporary file, held in memory up to UPLOAD_SPOOL_SIZE and on disk past it.
+    The file signature is checked as soon as its first bytes are in, so
+    anything that isn't a JPEG, PNG or WebP is refused before the rest is read.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._hasher = hashlib.blake2b(digest_size=16)
+        self._file = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE)
+        self._head = b''
+        self.mime_type = None
+
+    def on_data_received(self, chunk):
+        if self.mime_type is None:
+            self._head += chunk[:IMAGE_HEAD_SIZE]
+            if len(self._head) >= IMAGE_HEAD_SIZE:
+                self._check_signature()
+        self._hasher.update(chunk)
+        self._file.write(chunk)
+
+    def on_finish(self):
+        # Uploads shorter than IMAGE_HEAD_SIZE
+        if self.mime_type is None:
+            self._check_signature()
+
+    def _check_signature(self):
+        self.mime_type = sniff_image_type(self._head)
+        if self.mime_type is None:
+            raise UploadError('Unsupported image format', 415)
+
+    def digest(self):
+        """Same value as upload_digest() of the full upload"""
+        return self._hasher.digest()
+
+    def read(self):
+        """The whole upload as bytes; the temporary file is closed afterwards"""
+        self._file.seek(0)
+        data = self._file.read()
+        self._file.close()
+        return data
+
+
+async def read_upload_stream():
+    """
+    Parse the multipart body chunk by chunk as it arrives, instead of
+    letting the default form parser buffer and split it first.
+    Returns (SpooledUploadTarget for the image, dict of the option fields
+    that were sent).
+    Raises ParseFailedException on a malformed body and
+    RequestEntityTooLarge past MAX_CONTENT_LENGTH.
+    """
+    parser = StreamingFormDataParser(headers=request.headers)
+    image = SpooledUploadTarget()
+    parser.register('image', image)
+    fields = {name: ValueTarget() for name in OPTION_FIELDS}
+    for name, target in fields.items():
+        parser.register(name, target)
+
+    received = 0
+    async for chunk in request.body:
+        received += len(chunk)
+        if received > app.config['MAX_CONTENT_LENGTH']:
+            raise RequestEntityTooLarge()
+        parser.data_received(chunk)
+
+    # Undecodable bytes become U+FFFD, as with Werkzeug's form parser
+    form = {name: target.value.decode('utf-8', errors='replace')
+            for name, target in fields.items() if target.value}
+    return image, form
+
+
+async def read_image_upload():
+    """Validated (SpooledUploadTarget, options form) for a single-image upload"""
+    try:
+        img_target, form = await read_upload_stream()
+    except ParseFailedException:
+        raise UploadError('Expected a multipart/form-data upload')
+    except RequestEntityTooLarge:
+        raise UploadError('Upload too large', 413)
+
+    if img_target.multipart_filename is None:
+        raise UploadError('No image uploaded')
+
+    if not is_allowed_upload(img_target.multipart_filename):
+        raise UploadError('Unsupported file type')
+
+    return img_target, form
+
+
+def sse_event(event, payload):
+    """Encode one Server-Sent Event with a JSON payload"""
+    return b'event: ' + event.encode('ascii') + b'\ndata: ' + orjson.dumps(payload) + b'\n\n'
+
+
+def result_events(result, num):
+    """SSE events for every caption and song of an already complete result"""
+    for caption in result['captions'][:num]:
+        yield sse_event('caption', caption)
+    for song in result['songs'][:num]:
+        yield sse_event('song', song)
+
+
+OPTION_FIELDS = ('length', 'tone', 'region', 'mood', 'num')
+
+
+# The values the page's "number of options" picker sends
+NUM_CHOICES = {str(n): n for n in range(1, 7)}
+
 
+def read_options(form):
+    """Read caption/song options from the submitted form, with defaults"""
+    length = form.get('length','medium')
+    tone = form.get('tone','aesthetic')
+    region = form.get('region','any')
+    mood = form.get('mood','chill')
+    num = NUM_CHOICES.get(form.get('num','3'))
+    if num is None:
+        try:
+            num = max(1, min(6, int(form.get('num'))))
+        except:
+            num = 3
+    return length, tone, region, mood, num
+
+
+# Captions and songs asked for together (streaming and batch); filled in per
+# request by build_gemini_prompt. The rest is in SYSTEM_INSTRUCTION.
+GEMINI_PROMPT_TEMPLATE = """
+    Generate {max_outputs} Instagram captions and suggest {max_outputs} songs for this image.
+    Song region: {region} (MANDATORY)
+    Song mood: {mood}
+    Caption tone: {tone}
+    Caption length: {length}
+
+    {response_format}
+    """
 
-def call_gemini(prompt, image_bytes=None, max_outputs=3):
+JSON_RESPONSE_FORMAT = """Please respond in this EXACT JSON format:
+    {
+        "captions": ["caption 1", "caption 2", "caption 3"],
+        "songs": [
+            {"title": "Song Title", "artist": "Artist Name"},
+            {"title": "Song Title", "artist": "Artist Name"},
+            {"title": "Song Title", "artist": "Artist Name"}
+        ]
+    }"""
+
+# One JSON object per line lets streamed output be forwarded line by line
+LINES_RESPONSE_FORMAT = """Respond with one JSON object per line and nothing else, captions first:
+    {"caption": "caption 1"}
+    {"caption": "caption 2"}
+    {"title": "Song Title", "artist": "Artist Name"}
+    {"title": "Song Title", "artist": "Artist Name"}"""
+
+# Captions and songs can also be asked for separately, as two calls that run side by side.
+# These prompts hold only the per-request options; the rest is in SYSTEM_INSTRUCTION.
+CAPTION_PROMPT_TEMPLATE = """
+    Generate {max_outputs} Instagram captions for this image.
+    Caption tone: {tone}
+    Caption length: {length}
+
+    Please respond in this EXACT JSON format:
+    {{"captions": ["caption 1", "caption 2", "caption 3"]}}
+    """
+
+SONG_PROMPT_TEMPLATE = """
+    Suggest {max_outputs} songs that match this image.
+    Song region: {region} (MANDATORY)
+    Song mood: {mood}
+
+    Please respond in this EXACT JSON format:
+    {{"songs": [{{"title": "Song Title", "artist": "Artist Name"}}]}}
+    """
+
+# Instructions shared by every Gemini call, sent as the system instruction
+SYSTEM_INSTRUCTION = """You are LyricLens, a social-media assistant. Each request comes with a photo
+and asks for Instagram captions, song suggestions, or both.
+
+Song regions (the requested region is MANDATORY, only suggest songs from it):
+- bollywood: Only Hindi/Bollywood songs (artists like Arijit Singh, Shreya Ghoshal, A.R. Rahman, etc.)
+- hollywood: Only English/Western songs
+- tollywood: Only Telugu songs
+- kpop: Only Korean pop songs
+- any: Mix of popular songs from different regions
+
+Guidelines:
+- Analyze the image mood, colors, and setting
+- Make captions engaging and Instagram-ready
+- STRICTLY follow the region requirement for songs
+- Ensure songs are real and match the specified region
+- Match the mood and vibe of the image
+- Reply in the requested JSON format only"""
+
+
+def build_gemini_prompt(max_outputs, region="any", mood="chill", tone="aesthetic", length="medium",
+                        stream=False):
+    """Build the structured prompt sent to Gemini from the user's options"""
+    response_format = LINES_RESPONSE_FORMAT if stream else JSON_RESPONSE_FORMAT
+    return GEMINI_PROMPT_TEMPLATE.format(max_outputs=max_outputs, region=region, mood=mood,
+                                         tone=tone, length=length, response_format=response_format)
+
+
+def gemini_request_body(prompt_text, image_bytes, mime_type=None):
+    """generateContent request body with SYSTEM_INSTRUCTION, the prompt and the image inline"""
+    return {
+        "systemInstruction": {"parts": [{"text": SYSTEM_INSTRUCTION}]},
+        "contents": [{
+            "parts": [
+                {"text": prompt_text},
+                {"inline_data": {
+                    "mime_type": mime_type or image_mime_type(image_bytes),
+                    "data": base64.b64encode(image_bytes).decode('ascii')
+                }}
+            ]
+        }]
+    }
+
+
+# Most Gemini calls one worker makes at once, to stay inside the API rate limits
+# (per worker process; lower GEMINI_CONCURRENCY if Gemini answers 429)
+GEMINI_CONCURRENCY = int(os.getenv('GEMINI_CONCURRENCY', '8'))
+gemini_slots = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+
+# Explicit context caching needs a prefix of at least 1024 tokens, several
+# times the size of SYSTEM_INSTRUCTION, so it is sent inline with each call
+INSTRUCTION_CONFIG = types.GenerateContentConfig(system_instruction=SYSTEM_INSTRUCTION)
+
+
+# Longest a suggestion request (streamed or not) waits on Gemini, retries
+# included, before falling back to the mock suggestions
+GEMINI_TIMEOUT = 20  # seconds
+
+
+def is_retryable(error):
+    """Whether a failed Gemini call is worth repeating: rate limits and server errors"""
+    return isinstance(error, errors.APIError) and (error.code == 429 or error.code >= 500)
+
+
+# Backoff sleeps happen outside gemini_slots, so a waiting retry doesn't hold a slot
+gemini_retry = retry(retry=retry_if_exception(is_retryable), stop=stop_after_attempt(3),
+                     wait=wait_exponential_jitter(initial=0.5, max=4), reraise=True)
+
+
+@gemini_retry
+async def generate_text(prompt_text, image_part):
+    """One Gemini call with the prompt and image, waiting for a free slot first"""
+    async with gemini_slots:
+        response = await genai_client.aio.models.generate_content(
+            model=GEMINI_MODEL, contents=[prompt_text, image_part], config=INSTRUCTION_CONFIG)
+    return response.text or ''
+
+
+async def call_gemini(image_bytes, max_outputs=3,
+                      region="any", mood="chill", tone="aesthetic", length="medium",
+                      mime_type=None, cache_key=None):
     """
     Real implementation for calling Gemini API with image and text.
-    - prompt: string with instructions
+    Captions and songs are generated by two calls running side by side, so
+    the wait is the slower of the two rather than both one after the other.
     - image_bytes: bytes of the uploaded image
     - max_outputs: number of outputs to generate
+    - region, mood, tone, length: the user's song and caption options
+    - mime_type: type of image_bytes, sniffed from the bytes if omitted
+    - cache_key: if given, a successful Gemini result is stored under it
     """
-    if not GEMINI_API_KEY:
+    if not genai_client:
         # Fallback to mock data if no API key
-        return get_mock_response(prompt, max_outputs)
+        return get_mock_response(max_outputs, region, mood, tone, length)
     
     try:
-        # Use Gemini Pro Vision model for image + text
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        # Convert image bytes to PIL Image for Gemini
-        image = Image.open(BytesIO(image_bytes))
-        
-        # Parse the prompt to extract specific parameters
-        region = "any"
-        mood = "chill"
-        tone = "aesthetic"
-        length = "medium"
-        
-        # Extract parameters from prompt
-        if "Song region: " in prompt:
-            region = prompt.split("Song region: ")[1].split(".")[0].strip()
-        if "Song mood: " in prompt:
-            mood = prompt.split("Song mood: ")[1].split(".")[0].strip()
-        if "Tone: " in prompt:
-            tone = prompt.split("Tone: ")[1].split(".")[0].strip()
-        if "Caption length: " in prompt:
-            length = prompt.split("Caption length: ")[1].split(".")[0].strip()
-
-        # Enhanced prompt for better results with stronger region emphasis
-        enhanced_prompt = f"""
-        Analyze this image and generate {max_outputs} Instagram captions and {max_outputs} song suggestions.
-
-        IMPORTANT REQUIREMENTS:
-        1. For SONGS: The region "{region}" is MANDATORY. Only suggest songs from this region:
-           - If bollywood: Only Hindi/Bollywood songs (artists like Arijit Singh, Shreya Ghoshal, A.R. Rahman, etc.)
-           - If hollywood: Only English/Western songs
-           - If tollywood: Only Telugu songs
-           - If kpop: Only Korean pop songs
-           - If any: Mix of popular songs from different regions
-
-        2. Song mood should be: {mood}
-        3. Caption tone should be: {tone}
-        4. Caption length should be: {length}
-
-        Please respond in this EXACT JSON format:
-        {{
-            "captions": ["caption 1", "caption 2", "caption 3"],
-            "songs": [
-                {{"title": "Song Title", "artist": "Artist Name"}},
-                {{"title": "Song Title", "artist": "Artist Name"}},
-                {{"title": "Song Title", "artist": "Artist Name"}}
-            ]
-        }}
-
-        Guidelines:
-        - Analyze the image mood, colors, and setting
-        - STRICTLY follow the region requirement for songs
-        - Make captions engaging and Instagram-ready
-        - Ensure songs are real and match the specified region
-        - Match the mood and vibe of the image
-        """
+        caption_prompt = CAPTION_PROMPT_TEMPLATE.format(max_outputs=max_outputs, tone=tone,
+                                                        length=length)
+        song_prompt = SONG_PROMPT_TEMPLATE.format(max_outputs=max_outputs, region=region,
+                                                  mood=mood)
         
-        # Generate content with image and text
-        response = model.generate_content([enhanced_prompt, image])
-        
-        # Parse the response
-        response_text = response.text.strip()
-        
-        # Try to extract JSON from the response
+        # Generate captions and songs concurrently from the same image part
+        image_part = types.Part.from_bytes(data=image_bytes,
+                                           mime_type=mime_type or image_mime_type(image_bytes))
+        tasks = [asyncio.ensure_future(generate_text(caption_prompt, image_part)),
+                 asyncio.ensure_future(generate_text(song_prompt, image_part))]
         try:
-            # Look for JSON in the response
-            start_idx = response_text.find('{')
-            end_idx = response_text.rfind('}') + 1
-            
-            if start_idx != -1 and end_idx != 0:
-                json_str = response_text[start_idx:end_idx]
-                result = json.loads(json_str)
-                
-                # Validate the structure
-                if 'captions' in result and 'songs' in result:
-                    # Ensure we have the right number of items
-                    captions = result['captions'][:max_outputs]
-                    songs = result['songs'][:max_outputs]
-                    
-                    # Ensure songs have proper structure
-                    formatted_songs = []
-                    for song in songs:
-                        if isinstance(song, dict) and 'title' in song and 'artist' in song:
-                            formatted_songs.append(song)
-                        elif isinstance(song, str):
-                            # If it's just a string, try to parse it
-                            parts = song.split(' - ')
-                            if len(parts) >= 2:
-                                formatted_songs.append({"title": parts[0].strip(), "artist": parts[1].strip()})
-                            else:
-                                formatted_songs.append({"title": song.strip(), "artist": "Unknown Artist"})
-                    
-                    return {
-                        'captions': captions,
-                        'songs': formatted_songs
-                    }
-        except json.JSONDecodeError:
-            pass
+            caption_text, song_text = await asyncio.wait_for(asyncio.gather(*tasks),
+                                                             timeout=GEMINI_TIMEOUT)
+        finally:
+            # If one call failed, the other's result would be thrown away;
+            # cancel it so it gives up its gemini_slots slot
+            for task in tasks:
+                task.cancel()
         
-        # If JSON parsing fails, try to extract content manually
-        return parse_gemini_response(response_text, max_outputs)
+        # Parse the responses
+        captions = parse_partial_output(caption_text, 'captions', max_outputs)
+        songs = parse_partial_output(song_text, 'songs', max_outputs)
+        # Only cache a full set; a retry may get Gemini to fill the gaps
+        if cache_key is not None and len(captions) == len(songs) == max_outputs:
+            _response_cache[cache_key] = {'captions': captions, 'songs': songs}
+        return {
+            'captions': pad_with_mock(captions, 'captions', max_outputs),
+            'songs': pad_with_mock(songs, 'songs', max_outputs)
+        }
         
     except Exception as e:
-        print(f"Gemini API error: {e}")
+        app.logger.error("Gemini API error: %r", e)
         # Fallback to mock data on error
-        return get_mock_response(prompt, max_outputs)
+        return get_mock_response(max_outputs, region, mood, tone, length)
 
 
-def parse_gemini_response(response_text, max_outputs):
-    """Parse Gemini response when JSON format is not followed"""
-    captions = []
-    songs = []
+@gemini_retry
+async def open_stream(prompt_text, image_part):
+    """
+    Start a streamed Gemini call and wait for its first chunk, so failures
+    before anything has been yielded can be retried.
+    Returns (first chunk or None, the rest of the stream) while holding a
+    gemini_slots slot, which the caller must release.
+    """
+    await gemini_slots.acquire()
+    try:
+        stream = await genai_client.aio.models.generate_content_stream(
+            model=GEMINI_MODEL, contents=[prompt_text, image_part], config=INSTRUCTION_CONFIG)
+        first = await anext(stream, None)
+    except BaseException:
+        gemini_slots.release()
+        raise
+    return first, stream
+
+
+async def stream_gemini(image_bytes, max_outputs=3, region="any", mood="chill",
+                        tone="aesthetic", length="medium", mime_type=None):
+    """
+    Stream suggestions from Gemini as they are generated.
+    Yields ('caption', text) and ('song', {'title', 'artist'}) pairs, at most
+    max_outputs of each; errors are left to the caller.
+    """
+    prompt_text = build_gemini_prompt(max_outputs, region, mood, tone, length, stream=True)
+    image_part = types.Part.from_bytes(data=image_bytes,
+                                       mime_type=mime_type or image_mime_type(image_bytes))
+    counts = {'caption': 0, 'song': 0}
+    pending = ''
+    # The cap covers retries and the whole stream, which would otherwise
+    # hold its slot for as long as Gemini keeps trickling
+    async with asyncio.timeout(GEMINI_TIMEOUT):
+        chunk, stream = await open_stream(prompt_text, image_part)
+        try:
+            while chunk is not None:
+                pending += chunk.text or ''
+                # Everything before the last newline is a finished suggestion
+                *finished, pending = pending.split('\n')
+                for line in finished:
+                    item = parse_stream_line(line)
+                    if item and counts[item[0]] < max_outputs:
+                        counts[item[0]] += 1
+                        yield item
+                chunk = await anext(stream, None)
+        finally:
+            gemini_slots.release()
+
+    item = parse_stream_line(pending)
+    if item and counts[item[0]] < max_outputs:
+        yield item
+
+
+def parse_stream_line(line):
+    """Turn one line of streamed output into a ('caption'|'song', value) pair"""
+    line = line.strip().rstrip(',')
+    if not line.startswith('{'):
+        return None
+    try:
+        obj = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        return None
+    if not isinstance(obj, dict):
+        return None
+    if isinstance(obj.get('caption'), str):
+        return 'caption', obj['caption']
+    if isinstance(obj.get('title'), str):
+        return 'song', {"title": obj['title'], "artist": obj.get('artist') or "Unknown Artist"}
+    return None
+
+
+def first_json_object(text):
+    """
+    Return the first balanced {...} object in text, or None.
+    Braces inside JSON strings are skipped, so prose after the object
+    (often with braces of its own) is left out.
+    """
+    start = text.find('{')
+    if start == -1:
+        return None
+    depth = 0
+    in_string = escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+
+class Song(msgspec.Struct):
+    title: str
+    artist: str = "Unknown Artist"
+
+
+class GeminiResponse(msgspec.Struct):
+    captions: list[str]
+    songs: list[Union[Song, str]]
+
+
+class CaptionsResponse(msgspec.Struct):
+    captions: list[str]
+
+
+class SongsResponse(msgspec.Struct):
+    songs: list[Union[Song, str]]
+
+
+def format_songs(songs):
+    """Decoded songs as title/artist dicts"""
+    formatted_songs = []
+    for song in songs:
+        if isinstance(song, str):
+            # If it's just a string, try to parse it
+            title, _, artist = song.partition(' - ')
+            song = Song(title.strip(), artist.strip() or "Unknown Artist")
+        formatted_songs.append({"title": song.title, "artist": song.artist})
+    return formatted_songs
+
+
+def parse_gemini_output(response_text, max_outputs):
+    """Read captions and songs from Gemini's text output, JSON first"""
+    response_text = response_text.strip()
     
-    lines = response_text.split('\n')
-    current_section = None
+    # Try to extract JSON from the response
+    json_str = first_json_object(response_text)
+    if json_str is not None:
+        try:
+            # Parse and validate the structure in one pass
+            result = msgspec.json.decode(json_str, type=GeminiResponse)
+        except msgspec.DecodeError:
+            pass
+        else:
+            return {
+                'captions': result.captions[:max_outputs],
+                'songs': format_songs(result.songs[:max_outputs])
+            }
     
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-            
-        if 'caption' in line.lower() and len(captions) == 0:
-            current_section = 'captions'
-            continue
-        elif 'song' in line.lower() and len(songs) == 0:
-            current_section = 'songs'
-            continue
-        
-        if current_section == 'captions' and len(captions) < max_outputs:
-            # Clean up caption formatting
-            caption = line.replace('*', '').replace('-', '').replace('•', '').strip()
-            if caption and len(caption) > 5:
-                captions.append(caption)
-        
-        elif current_section == 'songs' and len(songs) < max_outputs:
-            # Try to extract song title and artist
-            song_line = line.replace('*', '').replace('-', '').replace('•', '').strip()
-            if ' by ' in song_line:
-                parts = song_line.split(' by ')
-                songs.append({"title": parts[0].strip(), "artist": parts[1].strip()})
-            elif ' - ' in song_line:
-                parts = song_line.split(' - ')
-                songs.append({"title": parts[0].strip(), "artist": parts[1].strip()})
-            elif song_line and len(song_line) > 3:
-                songs.append({"title": song_line, "artist": "Unknown Artist"})
+    # If JSON parsing fails, try to extract content manually
+    return parse_gemini_response(response_text, max_outputs)
+
+
+_PARTIAL_RESPONSES = {'captions': CaptionsResponse, 'songs': SongsResponse}
+
+
+def parse_partial_output(response_text, key, max_outputs):
+    """
+    Read just the captions or just the songs ('captions'/'songs' key) from
+    Gemini's output. Returns at most max_outputs items; fewer (even none) if
+    that is all Gemini wrote.
+    """
+    json_str = first_json_object(response_text)
+    if json_str is not None:
+        try:
+            items = getattr(msgspec.json.decode(json_str, type=_PARTIAL_RESPONSES[key]), key)
+        except msgspec.DecodeError:
+            pass
+        else:
+            items = items[:max_outputs]
+            return format_songs(items) if key == 'songs' else items
     
+    # The split prompts ask for no section headers, so unless Gemini added
+    # one, only bulleted or numbered lines count; anything else (such as a
+    # refusal) yields no items
+    text = split_sections(response_text).get(key[:-1])
+    if text is None:
+        text = '\n'.join(_MARKED_LINE_RE.findall(response_text))
+    return list_items(text, key, max_outputs)
+
+
+async def submit_batch(jobs):
+    """
+    Submit several generations as one Gemini Batch API job.
+    Batch jobs run offline at half the cost; poll the returned name for results.
+    - jobs: list of dicts with 'image_bytes', 'mime_type', 'max_outputs',
+      'region', 'mood', 'tone' and 'length'
+    """
+    lines = []
+    for i, job in enumerate(jobs):
+        prompt_text = build_gemini_prompt(job['max_outputs'], job['region'],
+                                          job['mood'], job['tone'], job['length'])
+        lines.append(orjson.dumps({
+            "key": f"req_{i}_n{job['max_outputs']}",
+            "request": gemini_request_body(prompt_text, job['image_bytes'], job['mime_type'])
+        }))
+
+    with tempfile.NamedTemporaryFile('wb', suffix='.jsonl', delete=False) as f:
+        f.write(b'\n'.join(lines))
+        path = f.name
+    try:
+        uploaded = await genai_client.aio.files.upload(
+            file=path, config={'display_name': 'lyriclens-batch', 'mime_type': 'jsonl'})
+    finally:
+        os.remove(path)
+
+    batch_job = await genai_client.aio.batches.create(
+        model=GEMINI_BATCH_MODEL, src=uploaded.name,
+        config={'display_name': 'lyriclens-batch'})
+    return batch_job.name
+
+
+def parse_batch_results(results_jsonl):
+    """Turn a downloaded batch results file into per-image caption/song results"""
+    results = []
+    for line in results_jsonl.splitlines():
+        if not line.strip():
+            continue
+        item = orjson.loads(line)
+        max_outputs = int(item['key'].rsplit('_n', 1)[1])
+        text = extract_response_text(item['response']) if 'response' in item else None
+        if text is not None:
+            result = parse_gemini_output(text, max_outputs)
+        elif 'response' in item:
+            # Blocked prompts come back with promptFeedback and no candidates
+            reason = item['response'].get('promptFeedback', {}).get('blockReason')
+            result = {'error': f'Blocked: {reason}' if reason else 'No candidates returned'}
+        else:
+            result = {'error': item.get('error', {}).get('message', 'Generation failed')}
+        result['key'] = item['key']
+        results.append(result)
+    results.sort(key=lambda r: int(r['key'].split('_')[1]))
+    return results
+
+
+def extract_response_text(data):
+    """Join the text parts of the first candidate in a Gemini REST response, or None without one"""
+    candidates = data.get('candidates')
+    if not candidates:
+        return None
+    parts = candidates[0].get('content', {}).get('parts', [])
+    return ''.join(part.get('text', '') for part in parts)
+
+
+# Section headers such as "Captions:", "**Songs:**" or "## Song Suggestions"
+_SECTION_RE = re.compile(
+    r"(?im)^[ \t]*(?:#+[ \t]*|\*\*)?(?:\w+[ \t]+){0,3}?(caption|song)s?\b"
+    r"(?:[ \t]+\w+){0,2}[ \t]*(?:\*\*)?[ \t]*:?[ \t]*(?:\*\*)?[ \t]*$")
+# List items, minus bullets, numbering and wrapping bold/quotes
+_ITEM_PREFIX = r"(?m)^[ \t]*(?:[-*•]+|\d+[.)])?[ \t]*\**\"?"
+_CAPTION_RE = re.compile(_ITEM_PREFIX + r"(.{6,}?)\"?\**[ \t]*$")
+_SONG_RE = re.compile(_ITEM_PREFIX + r"(.{4,}?)\"?\**(?:[ \t]+(?:by|-|–|—)[ \t]+(.+?))?[ \t]*$")
+# Markdown emphasis and bullets left inside an item (hyphens are kept: "sun-kissed")
+_STRAY_MARKS = str.maketrans('', '', '*•')
+# List items that start with a bullet or a number
+_MARKED_LINE_RE = re.compile(r"(?m)^[ \t]*(?:[-*•]+|\d+[.)])[ \t]+.*$")
+
+
+def split_sections(response_text):
+    """Map 'caption'/'song' to the text under the first header of that kind"""
+    sections = {}
+    headers = list(_SECTION_RE.finditer(response_text))
+    for i, header in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(response_text)
+        sections.setdefault(header.group(1).lower(), response_text[header.end():end])
+    return sections
+
+
+def list_items(text, key, max_outputs):
+    """Captions or songs ('captions'/'songs' key) listed one per line in text"""
+    if key == 'captions':
+        return [caption.translate(_STRAY_MARKS).strip()
+                for caption in _CAPTION_RE.findall(text)[:max_outputs]]
+    return [{"title": title.translate(_STRAY_MARKS).strip(),
+             "artist": artist.translate(_STRAY_MARKS).strip() or "Unknown Artist"}
+            for title, artist in _SONG_RE.findall(text)[:max_outputs]]
+
+
+def pad_with_mock(items, key, max_outputs):
+    """Fill items up to max_outputs with mock captions or songs"""
+    mock_items = get_mock_response(max_outputs)[key]
+    while len(items) < max_outputs:
+        items.append(mock_items[len(items) % len(mock_items)])
+    return items
+
+
+def parse_gemini_response(response_text, max_outputs):
+    """Parse Gemini response when JSON format is not followed"""
+    sections = split_sections(response_text)
     # If we didn't get enough results, fill with mock data
-    if len(captions) < max_outputs or len(songs) < max_outputs:
-        mock_data = get_mock_response("", max_outputs)
-        while len(captions) < max_outputs:
-            captions.append(mock_data['captions'][len(captions) % len(mock_data['captions'])])
-        while len(songs) < max_outputs:
-            songs.append(mock_data['songs'][len(songs) % len(mock_data['songs'])])
-    
     return {
-        'captions': captions[:max_outputs],
-        'songs': songs[:max_outputs]
+        'captions': pad_with_mock(list_items(sections.get('caption', ''), 'captions', max_outputs),
+                                  'captions', max_outputs),
+        'songs': pad_with_mock(list_items(sections.get('song', ''), 'songs', max_outputs),
+                               'songs', max_outputs)
     }
 
 
-def get_mock_response(prompt, max_outputs):
-    """Fallback mock response when API is unavailable"""
-    base_captions = [
-        "Stolen moments under golden skies",
-        "When the world felt like a soft melody",
-        "Sunlit streets and quiet thoughts",
-        "Lost in the little things",
-        "Weekend chapters written in sunlight",
-        "Chasing light and finding magic",
-        "Simple moments, infinite beauty"
-    ]
-    
-    # Region-specific song suggestions
-    bollywood_songs = [
+# Fallback captions and region-specific songs used when Gemini is unavailable
+BASE_CAPTIONS = (
+    "Stolen moments under golden skies",
+    "When the world felt like a soft melody",
+    "Sunlit streets and quiet thoughts",
+    "Lost in the little things",
+    "Weekend chapters written in sunlight",
+    "Chasing light and finding magic",
+    "Simple moments, infinite beauty"
+)
+
+SONGS_BY_REGION = {
+    "bollywood": (
         {"title": "Tum Hi Ho", "artist": "Arijit Singh"},
         {"title": "Raabta", "artist": "Arijit Singh"},
         {"title": "Channa Mereya", "artist": "Arijit Singh"},
@@ -222,19 +848,8 @@ def get_mock_response(prompt, max_outputs):
         {"title": "Kesariya", "artist": "Arijit Singh"},
         {"title": "Phir Bhi Tumko Chaahunga", "artist": "Arijit Singh"},
         {"title": "Dil Diyan Gallan", "artist": "Atif Aslam"}
-    ]
-    
-    hollywood_songs = [
-        {"title": "Golden Hour", "artist": "Joji"},
-        {"title": "Sunflower", "artist": "Post Malone"},
-        {"title": "Levitating", "artist": "Dua Lipa"},
-        {"title": "Blinding Lights", "artist": "The Weeknd"},
-        {"title": "Watermelon Sugar", "artist": "Harry Styles"},
-        {"title": "Good 4 U", "artist": "Olivia Rodrigo"},
-        {"title": "Stay", "artist": "The Kid LAROI & Justin Bieber"}
-    ]
-    
-    tollywood_songs = [
+    ),
+    "tollywood": (
         {"title": "Ala Vaikunthapurramuloo", "artist": "Armaan Malik"},
         {"title": "Inkem Inkem", "artist": "Sid Sriram"},
         {"title": "Samajavaragamana", "artist": "Sid Sriram"},
@@ -242,9 +857,8 @@ def get_mock_response(prompt, max_outputs):
         {"title": "Rangamma Mangamma", "artist": "MM Manasi"},
         {"title": "Buttabomma", "artist": "Armaan Malik"},
         {"title": "Ramuloo Ramulaa", "artist": "Anurag Kulkarni"}
-    ]
-    
-    kpop_songs = [
+    ),
+    "kpop": (
         {"title": "Dynamite", "artist": "BTS"},
         {"title": "Butter", "artist": "BTS"},
         {"title": "How You Like That", "artist": "BLACKPINK"},
@@ -252,25 +866,31 @@ def get_mock_response(prompt, max_outputs):
         {"title": "Next Level", "artist": "aespa"},
         {"title": "Savage", "artist": "aespa"},
         {"title": "LALISA", "artist": "LISA"}
-    ]
-
-    # Determine which songs to use based on prompt
-    base_songs = hollywood_songs  # default
-    if "bollywood" in prompt.lower():
-        base_songs = bollywood_songs
-    elif "tollywood" in prompt.lower():
-        base_songs = tollywood_songs
-    elif "kpop" in prompt.lower() or "k-pop" in prompt.lower():
-        base_songs = kpop_songs
-    elif "hollywood" in prompt.lower():
-        base_songs = hollywood_songs
-
-    # Simple deterministic pick seeded by prompt length
-    seed = sum(ord(c) for c in prompt) % len(base_captions) if prompt else 0
+    ),
+    "hollywood": (
+        {"title": "Golden Hour", "artist": "Joji"},
+        {"title": "Sunflower", "artist": "Post Malone"},
+        {"title": "Levitating", "artist": "Dua Lipa"},
+        {"title": "Blinding Lights", "artist": "The Weeknd"},
+        {"title": "Watermelon Sugar", "artist": "Harry Styles"},
+        {"title": "Good 4 U", "artist": "Olivia Rodrigo"},
+        {"title": "Stay", "artist": "The Kid LAROI & Justin Bieber"}
+    )
+}
+
+
+def get_mock_response(max_outputs, region="any", mood="", tone="", length=""):
+    """Fallback mock response when API is unavailable"""
+    # Songs from the requested region (hollywood for "any")
+    base_songs = SONGS_BY_REGION.get(region, SONGS_BY_REGION["hollywood"])
+
+    # Simple deterministic pick seeded by a CRC of the user's options
+    options = f"{length}:{tone}:{region}:{mood}:{max_outputs}"
+    seed = zlib.crc32(options.encode('utf-8')) % len(BASE_CAPTIONS)
     captions = []
     songs = []
     for i in range(max_outputs):
-        captions.append(base_captions[(seed + i) % len(base_captions)])
+        captions.append(BASE_CAPTIONS[(seed + i) % len(BASE_CAPTIONS)])
         songs.append(base_songs[(seed + i) % len(base_songs)])
 
     return {
@@ -280,7 +900,7 @@ def get_mock_response(prompt, max_outputs):
 
 
 # -----------------
-# Templates (render_template_string to keep single-file)
+# Templates (inline to keep single-file)
 # -----------------
 
 INDEX_HTML = '''
@@ -731,12 +1351,17 @@ const resultsArea = document.getElementById('resultsArea');
 
 let uploadedDataUrl = null;
 let uploadedBlob = null;
+let inFlight = null;  // AbortController of the running generation
+let optionTimer = null;
 
 imageInput.addEventListener('change', async (e) => {
   const file = e.target.files[0];
   if(!file) return;
   const ext = file.name.split('.').pop().toLowerCase();
-  if(!['jpg','jpeg','png'].includes(ext)) { alert('Unsupported file type'); return; }
+  if(!['jpg','jpeg','png','webp'].includes(ext)) { alert('Unsupported file type'); return; }
+
+  // Suggestions for the previous photo are no longer wanted
+  if(inFlight){ inFlight.abort(); inFlight = null; setStatus('', false); }
 
   const reader = new FileReader();
   reader.onload = function(ev) {
@@ -763,6 +1388,66 @@ function setStatus(msg, busy=false){
 
 function el(tag, cls, txt){ const d = document.createElement(tag); if(cls) d.className = cls; if(txt) d.textContent = txt; return d; }
 
+function addCaptionCard(col, c, length, tone){
+  const card = document.createElement('div'); card.className='result-card';
+  const p = document.createElement('div'); p.textContent = c; p.className='caption-text';
+  const chips = document.createElement('div'); chips.style.marginTop='12px';
+  chips.innerHTML = '<span class="chip">'+length+'</span><span class="chip">'+tone+'</span>';
+  const actions = document.createElement('div'); actions.className='actions';
+  const copy = document.createElement('button'); copy.className='btn-small'; copy.textContent='Copy';
+  copy.onclick = ()=>{ 
+    navigator.clipboard.writeText(c); 
+    copy.textContent='Copied ✓'; 
+    copy.className='btn-small success';
+    setTimeout(()=>{copy.textContent='Copy'; copy.className='btn-small';},1500); 
+  };
+  actions.appendChild(copy);
+  card.appendChild(p); card.appendChild(chips); card.appendChild(actions);
+  col.appendChild(card);
+}
+
+function addSongCard(col, s, region, mood){
+  const card = document.createElement('div'); card.className='result-card';
+  const p = document.createElement('div'); p.innerHTML = '<strong>'+s.title+'</strong> - '+s.artist; p.className='song-text';
+  const regionChip = document.createElement('div'); regionChip.style.marginTop='8px';
+  regionChip.innerHTML = '<span class="chip">'+region+'</span><span class="chip">'+mood+'</span>';
+  const actions = document.createElement('div'); actions.className='actions';
+  const yt = document.createElement('button'); yt.className='btn-small'; yt.textContent='🎵 Preview';
+  yt.onclick = ()=>{ window.open('https://www.youtube.com/results?search_query='+encodeURIComponent(s.title+' '+s.artist), '_blank') };
+  const copy = document.createElement('button'); copy.className='btn-small'; copy.textContent='Copy';
+  copy.onclick = ()=>{ 
+    navigator.clipboard.writeText(s.title+' - '+s.artist); 
+    copy.textContent='Copied ✓'; 
+    copy.className='btn-small success';
+    setTimeout(()=>{copy.textContent='Copy'; copy.className='btn-small';},1500); 
+  };
+  actions.appendChild(yt); actions.appendChild(copy);
+  card.appendChild(p); card.appendChild(regionChip); card.appendChild(actions);
+  col.appendChild(card);
+}
+
+// Read a text/event-stream response body, calling onEvent(name, data) per event
+async function readEvents(response, onEvent){
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  while(true){
+    const { value, done } = await reader.read();
+    if(done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let end;
+    while((end = buffer.indexOf('\\n\\n')) !== -1){
+      const frame = buffer.slice(0, end); buffer = buffer.slice(end + 2);
+      let name = 'message', data = '';
+      frame.split('\\n').forEach(line=>{
+        if(line.startsWith('event: ')) name = line.slice(7);
+        else if(line.startsWith('data: ')) data += line.slice(6);
+      });
+      onEvent(name, data ? JSON.parse(data) : null);
+    }
+  }
+}
+
 async function handleGenerate(){
   if(!uploadedBlob){ alert('Please upload a photo first'); return; }
   const length = document.getElementById('captionLength').value;
@@ -771,6 +1456,11 @@ async function handleGenerate(){
   const mood = document.getElementById('songMood').value;
   const num = parseInt(document.getElementById('numOptions').value)||3;
 
+  // Only one generation at a time: cancel the previous one
+  if(inFlight) inFlight.abort();
+  const ctrl = new AbortController();
+  inFlight = ctrl;
+
   setStatus('Generating - hang on a moment', true);
   resultsArea.innerHTML = '';
 
@@ -783,16 +1473,15 @@ async function handleGenerate(){
   form.append('num', num);
 
   try{
-    const r = await fetch('/generate', { method: 'POST', body: form });
-    const data = await r.json();
-    setStatus('');
-    if(data.error){ resultsArea.innerHTML = '<div class="muted">Error: '+data.error+'</div>'; return; }
-
-    const captions = data.captions || [];
-    const songs = data.songs || [];
-
-    if(captions.length===0 && songs.length===0){ resultsArea.innerHTML = '<div class="muted">No suggestions. Try different tone or length.</div>'; return; }
+    const r = await fetch('/generate/stream', { method: 'POST', body: form, signal: ctrl.signal });
+    if(!r.ok){
+      const data = await r.json();
+      setStatus('');
+      resultsArea.innerHTML = '<div class="muted">Error: '+data.error+'</div>';
+      return;
+    }
 
+    // Cards are added as each caption and song arrives
     const container = document.createElement('div');
     container.className = 'results';
 
@@ -802,126 +1491,240 @@ async function handleGenerate(){
     capCol.innerHTML = '<h4>Captions</h4>';
     songCol.innerHTML = '<h4>Songs</h4>';
 
-    captions.forEach((c,i)=>{
-      const card = document.createElement('div'); card.className='result-card';
-      const p = document.createElement('div'); p.textContent = c; p.className='caption-text';
-      const chips = document.createElement('div'); chips.style.marginTop='12px';
-      chips.innerHTML = '<span class="chip">'+document.getElementById('captionLength').value+'</span><span class="chip">'+document.getElementById('captionTone').value+'</span>';
-      const actions = document.createElement('div'); actions.className='actions';
-      const copy = document.createElement('button'); copy.className='btn-small'; copy.textContent='Copy';
-      copy.onclick = ()=>{ 
-        navigator.clipboard.writeText(c); 
-        copy.textContent='Copied ✓'; 
-        copy.className='btn-small success';
-        setTimeout(()=>{copy.textContent='Copy'; copy.className='btn-small';},1500); 
-      };
-      actions.appendChild(copy);
-      card.appendChild(p); card.appendChild(chips); card.appendChild(actions);
-      capCol.appendChild(card);
-    });
+    container.appendChild(capCol); container.appendChild(songCol);
+    resultsArea.appendChild(container);
 
-    songs.forEach((s,i)=>{
-      const card = document.createElement('div'); card.className='result-card';
-      const p = document.createElement('div'); p.innerHTML = '<strong>'+s.title+'</strong> - '+s.artist; p.className='song-text';
-      const regionChip = document.createElement('div'); regionChip.style.marginTop='8px';
-      regionChip.innerHTML = '<span class="chip">'+region+'</span><span class="chip">'+mood+'</span>';
-      const actions = document.createElement('div'); actions.className='actions';
-      const yt = document.createElement('button'); yt.className='btn-small'; yt.textContent='🎵 Preview';
-      yt.onclick = ()=>{ window.open('https://www.youtube.com/results?search_query='+encodeURIComponent(s.title+' '+s.artist), '_blank') };
-      const copy = document.createElement('button'); copy.className='btn-small'; copy.textContent='Copy';
-      copy.onclick = ()=>{ 
-        navigator.clipboard.writeText(s.title+' - '+s.artist); 
-        copy.textContent='Copied ✓'; 
-        copy.className='btn-small success';
-        setTimeout(()=>{copy.textContent='Copy'; copy.className='btn-small';},1500); 
-      };
-      actions.appendChild(yt); actions.appendChild(copy);
-      card.appendChild(p); card.appendChild(regionChip); card.appendChild(actions);
-      songCol.appendChild(card);
+    let received = 0;
+    await readEvents(r, (name, data)=>{
+      if(name === 'caption'){ addCaptionCard(capCol, data, length, tone); received++; }
+      else if(name === 'song'){ addSongCard(songCol, data, region, mood); received++; }
     });
 
-    container.appendChild(capCol); container.appendChild(songCol);
-    resultsArea.appendChild(container);
+    if(received===0){ resultsArea.innerHTML = '<div class="muted">No suggestions. Try different tone or length.</div>'; }
 
   }catch(err){
+    if(err.name === 'AbortError') return;
     console.error(err);
     setStatus('Something went wrong - check console', false);
-  }finally{ setStatus('', false); }
+  }finally{
+    // A newer generation owns the status and button now
+    if(inFlight === ctrl){ inFlight = null; setStatus('', false); }
+  }
 }
 
 generateBtn.addEventListener('click', handleGenerate);
+
+// Changing an option mid-generation restarts it with the new options,
+// once they have stopped changing for 250 ms
+['captionLength','captionTone','songRegion','songMood','numOptions'].forEach(id=>{
+  document.getElementById(id).addEventListener('change', ()=>{
+    if(!inFlight) return;
+    clearTimeout(optionTimer);
+    optionTimer = setTimeout(handleGenerate, 250);
+  });
+});
 </script>
 </body>
 </html>
 '''
 
+# The page has no template variables, so encode and compress it once at startup
+INDEX_BYTES = INDEX_HTML.encode('utf-8')
+INDEX_ENCODED = {
+    'br': brotli.compress(INDEX_BYTES, quality=11),
+    'gzip': gzip.compress(INDEX_BYTES, compresslevel=9),
+}
+# Weak validator: every encoding of the page shares it
+INDEX_ETAG = hashlib.blake2b(INDEX_BYTES, digest_size=8).hexdigest()
+
 # -----------------
 # Routes
 # -----------------
 
 @app.route('/')
-def index():
-    return render_template_string(INDEX_HTML)
+async def index():
+    headers = {'Cache-Control': 'public, max-age=3600', 'Vary': 'Accept-Encoding',
+               'ETag': f'W/"{INDEX_ETAG}"'}
+    # The browser already has this version of the page
+    if request.if_none_match.contains_weak(INDEX_ETAG):
+        return app.response_class(status=304, headers=headers)
+    encoding = request.accept_encodings.best_match(list(INDEX_ENCODED))
+    if encoding:
+        headers['Content-Encoding'] = encoding
+        body = INDEX_ENCODED[encoding]
+    else:
+        body = INDEX_BYTES
+    return app.response_class(body, headers=headers, mimetype='text/html')
 
 
 @app.route('/generate', methods=['POST'])
-def generate():
+async def generate():
     # Validate and load image
-    img_file = request.files.get('image')
-    if not img_file:
-        return jsonify({'error':'No image uploaded'}), 400
-
-    filename = secure_filename(img_file.filename)
-    ext = os.path.splitext(filename)[1].lower()
-    if ext not in app.config['UPLOAD_EXTENSIONS']:
-        return jsonify({'error':'Unsupported file type'}), 400
-
-    img_bytes = img_file.read()
+    upload, form = await read_image_upload()
 
     # Read options
-    length = request.form.get('length','medium')
-    tone = request.form.get('tone','aesthetic')
-    region = request.form.get('region','any')
-    mood = request.form.get('mood','chill')
-    try:
-        num = int(request.form.get('num','3'))
-        num = max(1, min(6, num))
-    except:
-        num = 3
-
-    # Build a clear prompt for the LLM with strong region emphasis
-    prompt = f"""You are a social-media assistant. I will provide a photo. Generate {num} caption suggestions and {num} song suggestions.
-
-CRITICAL REQUIREMENTS:
-- Caption length: {length}
-- Tone: {tone} 
-- Song region: {region} (THIS IS MANDATORY - only suggest songs from this region)
-- Song mood: {mood}
-
-For song region '{region}':
-- bollywood: Only Hindi/Bollywood songs (Arijit Singh, Shreya Ghoshal, A.R. Rahman, etc.)
-- hollywood: Only English/Western pop songs
-- tollywood: Only Telugu cinema songs
-- kpop: Only Korean pop songs
-- any: Mix from different regions
+    length, tone, region, mood, num = read_options(form)
+
+    # Same photo with the same options: reuse the earlier Gemini result
+    digest = upload.digest()
+    cache_key = response_cache_key(digest, length, tone, region, mood, num)
+    cached = cached_response(cache_key)
+    if cached is not None:
+        return json_response({'captions':cached['captions'][:num],'songs':cached['songs'][:num]})
 
-Provide captions as single lines and songs with title and artist."""
+    img_bytes, mime_type = await preprocess_image_cached(upload.read(), digest)
 
-    print(f"DEBUG: Generating for region: {region}, mood: {mood}, tone: {tone}, length: {length}")
+    app.logger.debug("Generating for region: %s, mood: %s, tone: %s, length: %s",
+                     region, mood, tone, length)
 
     try:
-        response = call_gemini(prompt, image_bytes=img_bytes, max_outputs=num)
-        print(f"DEBUG: Generated {len(response.get('songs', []))} songs for region {region}")
+        response = await call_gemini(img_bytes, max_outputs=num,
+                                     region=region, mood=mood, tone=tone, length=length,
+                                     mime_type=mime_type, cache_key=cache_key)
+        app.logger.debug("Generated %d songs for region %s", len(response.get('songs', [])), region)
     except Exception as e:
-        print(f"ERROR: {str(e)}")
-        return jsonify({'error':str(e)}), 500
+        app.logger.exception("Generation failed")
+        return json_response({'error':str(e)}, 500)
 
     # For safety, ensure we return simple JSON lists
     captions = response.get('captions', [])[:num]
     songs = response.get('songs', [])[:num]
 
-    return jsonify({'captions':captions,'songs':songs})
+    return json_response({'captions':captions,'songs':songs})
+
+
+@app.route('/generate/stream', methods=['POST'])
+async def generate_stream():
+    # Like /generate, but each caption and song is sent as a Server-Sent Event
+    # as soon as Gemini has written it
+    upload, form = await read_image_upload()
+    length, tone, region, mood, num = read_options(form)
+
+    digest = upload.digest()
+    cache_key = response_cache_key(digest, length, tone, region, mood, num)
+    cached = cached_response(cache_key)
+
+    async def events():
+        if cached is not None or not genai_client:
+            for event in result_events(cached or get_mock_response(num, region, mood, tone, length), num):
+                yield event
+            yield sse_event('done', {})
+            return
+
+        img_bytes, mime_type = await preprocess_image_cached(upload.read(), digest)
+        result = {'captions': [], 'songs': []}
+        failed = False
+        try:
+            async for kind, item in stream_gemini(img_bytes, max_outputs=num, region=region,
+                                                  mood=mood, tone=tone, length=length,
+                                                  mime_type=mime_type):
+                result['captions' if kind == 'caption' else 'songs'].append(item)
+                yield sse_event(kind, item)
+        except Exception as e:
+            app.logger.error("Gemini API error: %r", e)
+            failed = True
+
+        # Only a full set from Gemini is worth caching; mock items aren't
+        complete = not failed and all(len(items) == num for items in result.values())
+
+        # Top up with mock suggestions if Gemini stopped short
+        mock_data = get_mock_response(num, region, mood, tone, length)
+        for kind, key in (('caption', 'captions'), ('song', 'songs')):
+            for item in mock_data[key][len(result[key]):]:
+                result[key].append(item)
+                yield sse_event(kind, item)
+        if complete:
+            _response_cache[cache_key] = result
+        yield sse_event('done', {})
+
+    return app.response_class(events(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/metrics')
+async def metrics():
+    # Response cache counters for this worker, in the Prometheus text format
+    body = (
+        "# TYPE lyriclens_response_cache_hits_total counter\n"
+        f"lyriclens_response_cache_hits_total {cache_stats['hits']}\n"
+        "# TYPE lyriclens_response_cache_misses_total counter\n"
+        f"lyriclens_response_cache_misses_total {cache_stats['misses']}\n"
+        "# TYPE lyriclens_response_cache_entries gauge\n"
+        f"lyriclens_response_cache_entries {len(_response_cache)}\n"
+    )
+    return app.response_class(body, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/generate_batch', methods=['POST'])
+async def generate_batch():
+    # Queue several photos as one offline Batch API job and return its name
+    if not genai_client:
+        return json_response({'error':'Batch mode needs a GEMINI_API_KEY'}, 503)
+
+    files = await request.files
+    form = await request.form
+    img_files = files.getlist('image')
+    if not img_files:
+        return json_response({'error':'No image uploaded'}, 400)
+    if not all(is_allowed_upload(f.filename) for f in img_files):
+        return json_response({'error':'Unsupported file type'}, 400)
+    heads = [f.read(IMAGE_HEAD_SIZE) for f in img_files]
+    if not all(sniff_image_type(head) for head in heads):
+        return json_response({'error':'Unsupported image format'}, 415)
+
+    length, tone, region, mood, num = read_options(form)
+    images = await asyncio.gather(*(preprocess_image_cached(head + f.read())
+                                    for head, f in zip(heads, img_files)))
+    jobs = [{'image_bytes': img_bytes, 'mime_type': mime_type, 'max_outputs': num,
+             'region': region, 'mood': mood, 'tone': tone, 'length': length}
+            for img_bytes, mime_type in images]
+
+    try:
+        batch_name = await submit_batch(jobs)
+    except Exception as e:
+        app.logger.exception("Batch submission failed")
+        return json_response({'error':str(e)}, 500)
+
+    return json_response({'batch':batch_name}, 202)
+
+
+# Batch job states that may still produce results
+BATCH_ACTIVE_STATES = {'JOB_STATE_QUEUED', 'JOB_STATE_PENDING', 'JOB_STATE_RUNNING',
+                       'JOB_STATE_UPDATING'}
+# Finished states with a results file (a partial success covers some of the lines)
+BATCH_DONE_STATES = {'JOB_STATE_SUCCEEDED', 'JOB_STATE_PARTIALLY_SUCCEEDED'}
+
+
+@app.route('/batch_result/<path:name>')
+async def batch_result(name):
+    # Poll a batch job: 202 while it runs, its results once it has finished,
+    # and an error once it has failed, been cancelled or expired
+    if not genai_client:
+        return json_response({'error':'Batch mode needs a GEMINI_API_KEY'}, 503)
+
+    try:
+        batch_job = await genai_client.aio.batches.get(name=name)
+        state = batch_job.state.name
+        if state in BATCH_ACTIVE_STATES:
+            return json_response({'state':state}, 202)
+        if state not in BATCH_DONE_STATES:
+            message = batch_job.error.message if batch_job.error and batch_job.error.message else None
+            return json_response({'state':state,'error':message or 'Batch job did not finish'}, 502)
+        results_bytes = await genai_client.aio.files.download(file=batch_job.dest.file_name)
+    except Exception as e:
+        app.logger.exception("Batch lookup failed")
+        return json_response({'error':str(e)}, 500)
+
+    return json_response({'state':state,'results':parse_batch_results(results_bytes)})
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    if os.getenv('DEV'):
+        # Quart's single-process debug server with the reloader, for local work only
+        app.run(debug=True)
+    else:
+        from hypercorn.config import Config
+        from hypercorn.run import run
+        config = Config.from_pyfile(os.path.join(os.path.dirname(__file__), 'hypercorn_conf.py'))
+        config.application_path = 'app:app'
+        run(config)
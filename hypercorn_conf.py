@@ -0,0 +1,29 @@
+# Hypercorn settings for running LyricLens in production:
+#   hypercorn -c file:hypercorn_conf.py app:app
+import importlib.util
+import os
+
+bind = [os.getenv('BIND', '0.0.0.0:8000')]
+
+# Each worker is a separate process with its own event loop, so several
+# workers keep all cores busy while each one waits on many Gemini calls
+workers = int(os.getenv('WEB_CONCURRENCY', os.cpu_count() or 1))
+
+# uvloop's event loop is faster than asyncio's; it isn't available on Windows
+worker_class = 'uvloop' if importlib.util.find_spec('uvloop') else 'asyncio'
+
+# Connections waiting to be accepted while every worker is busy
+backlog = 2048
+
+# Keep idle browser connections open between an upload and the next one
+keep_alive_timeout = 75
+
+# Let in-flight generations finish on restart
+graceful_timeout = 60
+
+accesslog = '-'
+errorlog = '-'
+
+# HTTP/2 (several uploads over one connection) needs TLS
+certfile = os.getenv('CERTFILE')
+keyfile = os.getenv('KEYFILE')